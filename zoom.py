@@ -1,23 +1,89 @@
 from __future__ import print_function
+import json
 import pickle
+import re
+import stat
 import os.path
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow, Flow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
 from urllib.parse import urlparse, parse_qs, ParseResult
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+# The google client libraries are slow to import, so they're only imported when they're
+# needed (e.g. not when the events are served from the cache)
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 ZOOM_DOMAIN = "ellevationeducation"
+ZOOM_LINK_RE = re.compile(r"(?:https?://)?[^\s,]*zoom\.us[^\s,]*")
 NUM_NEXT = 5
+# Only ask the calendar API for the parts of each event that we actually look at
+EVENT_FIELDS = "items(id,summary,start,end,location,conferenceData/entryPoints/uri)"
 # Skip the first meeting and join the second if it starts within this many minutes of now
 SKIP_FIRST_IF_NEXT_STARTS_WITHIN = 3
+# Where to keep the calendar API discovery document and how long to trust it for
+DISCOVERY_CACHE_FILE = os.path.expanduser("~/.cache/join-zoom/calendar-v3.json")
+DISCOVERY_CACHE_TTL = timedelta(days=7)
+# Where to keep the most recent events and how long they can be reused for. The TTL is
+# extended when the script is being invoked repeatedly in quick succession.
+EVENTS_CACHE_FILE = os.path.expanduser("~/.cache/join-zoom/events.json")
+EVENTS_CACHE_TTL = timedelta(seconds=30)
+EVENTS_CACHE_ACTIVE_TTL = timedelta(seconds=60)
+EVENTS_CACHE_ACTIVE_WITHIN = timedelta(seconds=2)
+
+
+class DiscoveryFileCache:
+    """Keeps the discovery document on disk so build() doesn't have to fetch it every run.
+
+    build() only calls get and set, so this doesn't subclass googleapiclient's Cache
+    and importing this module doesn't pull in googleapiclient.
+    """
+
+    def __init__(self, path: str, ttl: timedelta):
+        self.path = path
+        self.ttl = ttl
+
+    def get(self, url):
+        try:
+            age = datetime.now().timestamp() - os.path.getmtime(self.path)
+            if age > self.ttl.total_seconds():
+                return None
+            with open(self.path) as f:
+                content = f.read()
+            # Don't hand build() a partial or corrupt document, fetch it again instead
+            json.loads(content)
+            return content
+        except (OSError, ValueError):
+            return None
+
+    def set(self, url, content):
+        try:
+            _write_private_file(self.path, content)
+        except OSError as e:
+            print(f"Unable to cache discovery document: {e}")
+
+
+def _write_private_file(path: str, content: str) -> None:
+    """Atomically replace the file at path with content, readable only by this user"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # mkstemp creates the file with 0600 permissions in the same directory, so the
+    # final rename never leaves a partially written file at path
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 
-def _fetch_creds() -> Credentials:
+def _fetch_creds() -> "Credentials":
     """Attempts to load credentials from a pickle otherwise logs you in to get a token"""
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
@@ -29,8 +95,10 @@ def _fetch_creds() -> Credentials:
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow: InstalledAppFlow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', SCOPES)
             creds: Credentials = flow.run_local_server(port=0)
@@ -53,24 +121,19 @@ def is_not_day_only(event: dict) -> bool:
 
 def get_zoom_link(event: dict) -> str:
     """Return the zoom link from the event data if it exists"""
-    # First let's look in the location
-    loc = event.get("location", "")
-    if "zoom.us" in loc:
-        # If the meeting is setup as zoom as a location, then it may have multiple.
-        # Split as csv and find the first with zoom.us in it.
-        if "," in loc:
-            loc = next(l for l in loc.split(",") if "zoom.us" in l)
-        return loc
-    
+    # First let's look in the location. If the meeting is setup with zoom as a location
+    # then it may have multiple (comma separated), so take the first zoom link.
+    match = ZOOM_LINK_RE.search(event.get("location", ""))
+    if match:
+        return match.group(0)
+
     eps = event.get("conferenceData", {}).get("entryPoints", [])
-    # Sometimes an event returns an empty array here which results in a StopIteration
-    # error when we try to use the following for loop
     if eps:
-        found = next(ep for ep in eps if "zoom.us" in ep.get("uri", ""))
+        found = next((ep["uri"] for ep in eps if ZOOM_LINK_RE.search(ep.get("uri", ""))),
+                     None)
         if found:
-            return found["uri"]
-        else:
-            print("\tConference data found, but no zoom links in it")
+            return found
+        print("\tConference data found, but no zoom links in it")
     else:
         print("\tNo conference data found for event")
         # print(event)
@@ -78,10 +141,6 @@ def get_zoom_link(event: dict) -> str:
     return None
 
 
-def has_zoom_link(event: dict) -> bool:
-    return get_zoom_link(event) is not None
-
-
 def convert_to_zoom_protocol(url: str) -> str:
     """Take the incoming url and convert it to a zoom protocol url
 
@@ -107,57 +166,132 @@ def convert_to_zoom_protocol(url: str) -> str:
     return "".join(zoom_url)
 
 
+def parse_event_datetime(value: str) -> Optional[datetime]:
+    """Parse an RFC3339 timestamp from the calendar API, returning None if it isn't one.
+
+    Before python 3.11 datetime.fromisoformat doesn't accept the trailing Z the API
+    uses for UTC times, so swap that for an explicit offset first.
+    """
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    try:
+        return datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        return None
+
+
 def find_event_to_join(now: datetime, events: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Find the event to join"""
     first = events[0]
     if len(events) > 1:
         second = events[1]
         start = second['start'].get('dateTime', second['start'].get('date'))
-        time = datetime.fromisoformat(start)
-        delta = time - now
-        if delta < timedelta(minutes=SKIP_FIRST_IF_NEXT_STARTS_WITHIN):
+        time = parse_event_datetime(start)
+        delta = time - now if time else None
+        if delta is not None and delta < timedelta(minutes=SKIP_FIRST_IF_NEXT_STARTS_WITHIN):
             print(f"Second event starts in {delta.min} minutes so joining that one")
             first = second
 
     return first
 
 
-def main():
-    """Shows basic usage of the Google Calendar API.
-    Prints the start and name of the next 10 events on the user's calendar.
-    """
+def _load_cached_events(now: datetime) -> Optional[List[Dict[str, Any]]]:
+    """Return the cached events if they were fetched recently enough, otherwise None"""
+    try:
+        with open(EVENTS_CACHE_FILE) as f:
+            # The cached links end up in a shell command, so only trust a regular file
+            # that we wrote ourselves
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+                print("Ignoring events cache not owned by the current user")
+                return None
+            cached = json.load(f)
+        fetched_at = datetime.fromtimestamp(cached["fetched_at"], tz=timezone.utc)
+        last_used = datetime.fromtimestamp(cached["last_used"], tz=timezone.utc)
+        events = cached["items"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    ttl = EVENTS_CACHE_TTL
+    if timedelta(0) <= now - last_used < EVENTS_CACHE_ACTIVE_WITHIN:
+        ttl = EVENTS_CACHE_ACTIVE_TTL
+    if not timedelta(0) <= now - fetched_at < ttl:
+        return None
+
+    _write_events_cache(fetched_at, now, events)
+    return events
+
+
+def _write_events_cache(fetched_at: datetime, last_used: datetime,
+                        events: List[Dict[str, Any]]) -> None:
+    try:
+        _write_private_file(EVENTS_CACHE_FILE,
+                            json.dumps(dict(fetched_at=fetched_at.timestamp(),
+                                            last_used=last_used.timestamp(),
+                                            items=events)))
+    except OSError as e:
+        print(f"Unable to cache events: {e}")
+
 
-    creds = _fetch_creds()
-    service = build('calendar', 'v3', credentials=creds)
+def fetch_events(now: datetime) -> List[Dict[str, Any]]:
+    """Fetch the next few events from the Google Calendar API, reusing a recent result
+    if there is one"""
+    events = _load_cached_events(now)
+    if events is not None:
+        print(f"Using {len(events)} cached events")
+        return events
+
+    from googleapiclient.discovery import build
+    from googleapiclient.http import build_http
+    from google_auth_httplib2 import AuthorizedHttp
+
+    # Loading (and possibly refreshing) the credentials and fetching the discovery
+    # document are both network bound, so do them in parallel. The service is built
+    # with a plain http object and the credentials are only attached when executing.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        creds_future = executor.submit(_fetch_creds)
+        service = build('calendar', 'v3', http=build_http(),
+                        cache=DiscoveryFileCache(DISCOVERY_CACHE_FILE, DISCOVERY_CACHE_TTL))
+        creds = creds_future.result()
 
     # Call the Calendar API
-    now: datetime = datetime.now(tz=timezone.utc)
-    # now: datetime = datetime.now(tz=timezone.utc) - timedelta(hours=1)
     now_str: str = now.isoformat()
     print(f"Getting the upcoming {NUM_NEXT} events from {now_str}")
     events_result = service.events().list(calendarId='primary', timeMin=now_str,
                                         maxResults=NUM_NEXT, singleEvents=True,
-                                        orderBy='startTime').execute()
+                                        orderBy='startTime', fields=EVENT_FIELDS).execute(
+                                            http=AuthorizedHttp(creds, http=build_http()))
     events = events_result.get('items', [])
+    _write_events_cache(now, now, events)
+    return events
+
+
+def main():
+    """Shows basic usage of the Google Calendar API.
+    Prints the start and name of the next 10 events on the user's calendar.
+    """
+
+    now: datetime = datetime.now(tz=timezone.utc)
+    # now: datetime = datetime.now(tz=timezone.utc) - timedelta(hours=1)
+    events = fetch_events(now)
+    # Work out the zoom link for each event in a single pass, keeping the ones we can
+    # join (and printing everything for debugging purposes)
+    filtered: List[Dict[str, Any]] = []
+    zoom_urls: Dict[str, str] = {}
     for event in events:
         start = event['start'].get('dateTime', event['start'].get('date'))
         summary = event["summary"]
         is_not_day = is_not_day_only(event)
-        has_zoom = False
-        if is_not_day:
-            has_zoom = has_zoom_link(event)
-        print(start, summary, is_not_day, has_zoom)
+        link = get_zoom_link(event) if is_not_day else None
+        print(start, summary, is_not_day, link is not None)
+        if link is not None:
+            zl = convert_to_zoom_protocol(link)
+            print(f"\t{zl}")
+            filtered.append(event)
+            zoom_urls[event["id"]] = zl
 
     if not events:
         print('No upcoming events found.')
-    filtered = list(filter(has_zoom_link, filter(is_not_day_only, events)))
-    # Debugging purposes...
-    for event in filtered:
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        summary = event["summary"]
-        link = get_zoom_link(event)
-        zl = convert_to_zoom_protocol(link)
-        print(start, summary, zl)
 
     if filtered:
         e = find_event_to_join(now, filtered)
@@ -165,7 +299,7 @@ def main():
             print()
             print("Joining zoom for")
             summary = e["summary"]
-            zl = convert_to_zoom_protocol(get_zoom_link(e))
+            zl = zoom_urls[e["id"]]
             print(summary, zl)
             cmd = f"open \"{zl}\""
             print(f"\t{cmd}")